@@ -4,95 +4,171 @@
 # @Blog    : yaoleo.github.io
 import json
 import re
-import fnmatch
 import os
+from concurrent.futures import ThreadPoolExecutor
+from tqdm import tqdm
 
-def load_qadata(qa_dir):
+try:
+    from orjson import dumps as _dumps
+except ImportError:
+    def _dumps(obj):
+        return json.dumps(obj, ensure_ascii=False).encode('utf-8')
+
+_QA_RE = re.compile(r'QA_\d+_')
+_SPLIT_T = re.compile(r'\s*<t>\s*')
+_WS_STRIP = str.maketrans('', '', ' \t\n\r\v\f')
+# Only these per-QA fields are consumed by testGenerate; the rest are read from the flat files.
+_QA_KEYS = {"state", "response_entities", "orig_response", "context_utterance"}
+# Upper bound on the number of leaf directories handed to one pool task.
+_READ_BATCH = 256
+
+def _iter_leaves(top):
+    """Yield (dirpath, file entries) for every directory under `top` without subdirectories."""
+    stack = [top]
+    while stack:
+        d = stack.pop()
+        subs = []
+        files = []
+        with os.scandir(d) as it:
+            for e in it:
+                (subs if e.is_dir() else files).append(e)
+        if not subs:
+            yield d, files
+        else:
+            stack.extend(s.path for s in subs)
+
+def _mask_ids(tokens, prefix):
+    """Map each token to `prefix` + the 1-based position of its first occurrence."""
+    mask = {}
+    for i, token in enumerate(tokens, 1):
+        if token not in mask:
+            mask[token] = f'{prefix}{i}'
+    return mask
+
+def build_record(entity, relation, type_, question, state, response_entity, orig_response, count):
+    """Build one test annotation from already stripped fields. Returns (ID_string, record)."""
+    entities = [e for e in _SPLIT_T.split(entity) if e]
+    relations = [e for e in _SPLIT_T.split(relation) if e]
+    types = [e for e in _SPLIT_T.split(type_) if e]
+    relation_maskID = {}
+    for relation in relations:
+        relation = relation.replace('-', '')
+        if relation not in relation_maskID:
+            relation_maskID[relation] = f'RELATION{len(relation_maskID) + 1}'
+    # count is strictly increasing, so IDs never collide and records are written without a dedupe check.
+    ID_string = (state + str(count)).translate(_WS_STRIP)
+    return ID_string, {
+        'question': question,
+        'entity': entities,
+        'relation': relations,
+        'type': types,
+        'response_entities': response_entity,
+        'orig_response': orig_response,
+        'entity_mask': _mask_ids(entities, 'ENTITY'),
+        'relation_mask': relation_maskID,
+        'type_mask': _mask_ids(types, 'TYPE'),
+    }
+
+def _read_lines(path):
+    with open(path, 'rb') as fh:
+        return fh.read().splitlines()
+
+def _read_leaf(leaf):
+    """Read the QA fields of one leaf directory. Returns (qa_id, qa_dict)."""
+    root, files = leaf
+    qa_dict = {}
+    for f in files:
+        if not f.name.endswith('.txt'):
+            continue
+        keystr = _QA_RE.sub('', f.name)[:-4]
+        if keystr not in _QA_KEYS:
+            continue
+        # Lines are kept as raw bytes and decoded only when consumed.
+        with open(f.path, 'rb', buffering=0) as fh:
+            qa_dict[keystr] = fh.read().splitlines()
+    return root[root.rfind("_")+1:], qa_dict
+
+def _read_leaves(batch):
+    return [_read_leaf(leaf) for leaf in batch]
+
+def load_qadata(qa_dir, max_workers=32):
     """
 
     :param qa_dir: 预处理后的qa数据的文件夹，eg：/home/zhangjingyao/preprocessed_data_10k/test
+    :param max_workers: number of threads reading leaf directories concurrently.
     :return: 这个文件夹下面，问答数据的字典。最外层是序号: QA_1_
     """
     print("begin_load_qadata")
     qa_set = {}
-    for root, dirnames, filenames in os.walk(qa_dir):
-        if(dirnames == []):
-            qa_id = root[root.rfind("_")+1:]
-            qa_dict ={}
-            for filenames in fnmatch.filter(filenames, '*.txt'):
-                pattern = re.compile('QA_\d+_')
-                keystr = re.sub(pattern,"", filenames).replace(".txt","")
-                qa_dict[keystr] = open(root+"/"+filenames).readlines()
-            qa_set[qa_id] = qa_dict
+    leaves = list(_iter_leaves(qa_dir))
+    # Submit the leaves in batches so that each task issues a run of reads back to back
+    # instead of paying one future per directory, while still keeping every worker busy.
+    size = max(1, min(_READ_BATCH, len(leaves) // max_workers))
+    batches = [leaves[i:i + size] for i in range(0, len(leaves), size)]
+    # The reads are I/O bound and release the GIL, so threads overlap the per-file syscalls.
+    with ThreadPoolExecutor(max_workers=max_workers) as ex:
+        for results in ex.map(_read_leaves, batches):
+            for qa_id, qa_dict in results:
+                qa_set[qa_id] = qa_dict
     print("load_qadata_success")
     return qa_set
 
 def testGenerate():
     qa_set = load_qadata("/data/zjy/test_full")
-    dict_keys = sorted(qa_set.keys())
-    val = []
+    # The flat files below were dumped in this (lexicographic) qa_id order and are matched to the
+    # qa_set columns line by line, so the ordering must not become numeric.
+    dict_keys = sorted(qa_set)
     state_val = []
     response_entity_val = []
     orig_response_val = []
     q_val = []
     for k in dict_keys:
-        v = qa_set[k]
+        # Each QA is consumed exactly once, so release it as soon as its columns are copied.
+        v = qa_set.pop(k)
         if v !={}:
-            for s,r,o,c in zip(v["state"],v["response_entities"],v["orig_response"],v["context_utterance"]):
-                state_val.append(s)
-                response_entity_val.append(r)
-                orig_response_val.append(o)
-                q_val.append(c)
-        val.append(v)
-    with open("CSQA_ANNOTATIONS_test.json", 'w', encoding="UTF-8") as test_json, open("new_entities.txt", 'r', encoding="UTF-8") as test_entities\
-            , open("test_questions.txt", 'r', encoding="UTF-8") as test_questions, open("test_types.txt", 'r', encoding="UTF-8") as test_types \
-            , open("test_relations.txt", 'r', encoding="UTF-8") as test_relations:
+            columns = (v["state"], v["response_entities"], v["orig_response"], v["context_utterance"])
+            # The four files of a QA are line-aligned; truncate to the shortest one, as zip did.
+            n = min(map(len, columns))
+            for out, column in zip((state_val, response_entity_val, orig_response_val, q_val), columns):
+                out.extend(column if len(column) == n else column[:n])
+    # Entities, relations and types come from the flat files on purpose: they hold the linker output
+    # for the test questions, which the per-QA dumps (gold context_* fields only) do not contain.
+    # test_questions.txt is kept to check that the flat files and qa_set stay aligned.
+    test_entities = _read_lines("new_entities.txt")
+    test_relations = _read_lines("test_relations.txt")
+    test_types = _read_lines("test_types.txt")
+    test_questions = _read_lines("test_questions.txt")
+    # The flat files and the qa_set columns are aligned line by line; stop at the shortest one.
+    total = min(len(test_entities), len(test_relations), len(test_types), len(test_questions),
+                len(state_val), len(response_entity_val), len(orig_response_val), len(q_val))
+    with open("CSQA_ANNOTATIONS_test.json", 'wb', buffering=1 << 20) as test_json, \
+            open("CSQA_ANNOTATIONS_test_mismatch.log", 'w', encoding="UTF-8") as mismatch_log:
         count = 1
 
-
-        question_dict = {}
-        question_info_new = {}
-        for entity,relation,type,question,state,response_entity,orig_response,qqq in zip(test_entities,
-                    test_relations, test_types, test_questions,state_val,response_entity_val,orig_response_val,q_val):
-            ID_string = "test" + str(count)
-            entities = [e.strip() for e in  entity.strip().split("<t>") if e != '']
-            relations = [e.strip() for e in  relation.strip().split("<t>") if e != '']
-            types = [e.strip() for e in  type.strip().split("<t>") if e != '']
-
-            ID_string = state.strip() + str(count)
-            if(count%1000 == 0): print(count)
-
-            ID_string = "".join(ID_string.split())
-            question_info_new = {}
-            question_info_new.setdefault('question', question.strip())
-            if(question.strip()!= qqq.strip()):print(ID_string,question,qqq)
-            question_info_new.setdefault('entity', entities)
-            question_info_new.setdefault('relation', relations)
-            question_info_new.setdefault('type', types)
-            question_info_new.setdefault('response_entities', response_entity)
-            question_info_new.setdefault('orig_response', orig_response)
-            entity_maskID = {}
-            if len(entities) != 0:
-                for i, entity in enumerate(entities):
-                    entity_maskID.setdefault(entity, 'ENTITY' + str(i + 1))
-            question_info_new.setdefault('entity_mask', entity_maskID)
-            relation_maskID = {}
-            if len(relations) != 0:
-                relation_index = 0
-                for relation in relations:
-                    relation = relation.replace('-', '')
-                    if relation not in relation_maskID:
-                        relation_index += 1
-                        relation_maskID.setdefault(relation, 'RELATION' + str(relation_index))
-            question_info_new.setdefault('relation_mask', relation_maskID)
-            type_maskID = {}
-            if len(types) != 0:
-                for i, type in enumerate(types):
-                    type_maskID.setdefault(type, 'TYPE' + str(i + 1))
-            question_info_new.setdefault('type_mask', type_maskID)
-            question_dict.setdefault(ID_string, question_info_new)
+        # Records are streamed to disk one at a time instead of being collected into one big dict;
+        # every entry except the first is preceded by a comma.
+        test_json.write(b'{')
+        sep = b'\n'
+        for i in tqdm(range(total), total=total):
+            # Every field is decoded and stripped exactly once, here.
+            question = test_questions[i].decode('utf-8').strip()
+            qqq = q_val[i].decode('utf-8').strip()
+            ID_string, question_info_new = build_record(
+                test_entities[i].decode('utf-8').strip(),
+                test_relations[i].decode('utf-8').strip(),
+                test_types[i].decode('utf-8').strip(),
+                question,
+                state_val[i].decode('utf-8').strip(),
+                response_entity_val[i].decode('utf-8').strip(),
+                orig_response_val[i].decode('utf-8').strip(),
+                count)
+            if question != qqq:
+                # Flat files and qa_set are out of step here; keep the trace off the terminal.
+                mismatch_log.write("%s\t%s\t%s\n" % (ID_string, question, qqq))
+            test_json.write(sep + _dumps(ID_string) + b': ' + _dumps(question_info_new))
+            sep = b',\n'
             count+=1
-        test_json.writelines(json.dumps(question_dict, indent=1, ensure_ascii=False,sort_keys=False))
+        test_json.write(b'\n}\n')
 
 
 if __name__ == "__main__":
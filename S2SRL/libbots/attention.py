@@ -60,7 +60,8 @@ class Attention(nn.Module):
             unpack_output = output
         batch_size = unpack_output.size(0)
         hidden_size = unpack_output.size(2)
-        context_trans = context.view(1, -1, context.size(1))
+        # A 2-D context belongs to a single sequence; a 3-D one already carries one context per batch row.
+        context_trans = context if context.dim() == 3 else context.view(1, -1, context.size(1))
         input_size = context_trans.size(1)
         # for idx1, temp1 in enumerate(unpack_output[0]):
         #     for idx, temp in enumerate(context_trans[0]):
@@ -85,5 +86,5 @@ class Attention(nn.Module):
         # output -> (batch, out_len, dim)
         output_result = torch.tanh(self.linear_out(combined.view(-1, 2 * hidden_size))).view(-1, hidden_size)
         # Transform result into PackedSequence format.
-        packed_output_result = rnn_utils.PackedSequence(output_result, output.batch_sizes.detach()) if isinstance(output, rnn_utils.PackedSequence) else output_result.view(1, -1, hidden_size)
+        packed_output_result = rnn_utils.PackedSequence(output_result, output.batch_sizes.detach()) if isinstance(output, rnn_utils.PackedSequence) else output_result.view(batch_size, -1, hidden_size)
         return packed_output_result, attn
@@ -6,7 +6,14 @@ import torch.optim as optim
 import torch.nn.functional as F
 import random
 import logging
+import multiprocessing
+import os
+import numpy as np
 from torch.utils.data.sampler import WeightedRandomSampler
+try:
+    from torch.func import functional_call
+except ImportError:
+    from torch.nn.utils.stateless import functional_call
 log = logging.getLogger("MetaLearner")
 
 class MetaLearner(object):
@@ -28,15 +35,26 @@ class MetaLearner(object):
         Pieter Abbeel, "Trust Region Policy Optimization", 2015
         (https://arxiv.org/abs/1502.05477)
     """
-    def __init__(self, net=None, retriever_net = None, device='cpu', beg_token=None, end_token = None, adaptive=False, samples=5, train_data_support_944K=None, rev_emb_dict=None, first_order=False, fast_lr=0.001, meta_optimizer_lr=0.0001, dial_shown = False, dict=None, dict_weak=None, steps=5, weak_flag=False, query_embed=True):
+    def __init__(self, net=None, retriever_net = None, device='cpu', beg_token=None, end_token = None, adaptive=False, samples=5, train_data_support_944K=None, rev_emb_dict=None, first_order=True, fast_lr=0.001, meta_optimizer_lr=0.0001, dial_shown = False, dict=None, dict_weak=None, steps=5, weak_flag=False, query_embed=True, disable_skip=False):
         self.net = net
         self.retriever_net = retriever_net
         self.device = device
-        self.beg_token = beg_token
+        # Placed on the device once so the embedding lookup in inner_loss needs no copy.
+        self.beg_token = None if beg_token is None else beg_token.to(device)
         self.end_token = end_token
         # The training data from which the top-N samples (support set) are found.
         self.train_data_support_944K = train_data_support_944K
         self.rev_emb_dict = rev_emb_dict
+        # Uppercased output token of every ID, with '#END' and unknown IDs masked out, so that
+        # a decoded action sequence is turned into tokens by one array lookup (see _action_tokens).
+        self._rev_emb_arr = np.empty(0, dtype=object)
+        self._rev_emb_valid = np.zeros(0, dtype=bool)
+        if rev_emb_dict:
+            size = max(rev_emb_dict) + 1
+            self._rev_emb_arr = np.array([str(rev_emb_dict[i]).upper() if i in rev_emb_dict else None
+                                          for i in range(size)], dtype=object)
+            self._rev_emb_valid = np.array([i in rev_emb_dict and rev_emb_dict[i] != '#END' for i in range(size)],
+                                           dtype=bool)
         self.adaptive = adaptive
         self.samples = samples
         self.first_order = first_order
@@ -53,6 +71,12 @@ class MetaLearner(object):
         self.steps = steps
         self.weak_flag = weak_flag
         self.query_embed = query_embed
+        # Whether to keep training samples whose argmax decode is already rewarded above 0.99.
+        self.disable_skip = disable_skip
+        # Worker processes for utils.calc_True_Reward, see _calc_rewards.
+        self._reward_pool = None
+        # Whether sample() has left meta-gradients in .grad for meta_update to apply.
+        self._meta_grads_ready = False
         '''# note: Reparametrize it!
         self.reparam_net = reparam_module.ReparamModule(self.net)
         print(f"reparam_net has {self.reparam_net.param_numel} parameters")
@@ -97,24 +121,22 @@ class MetaLearner(object):
                 # old_param = old_param_dict[name].clone().detach()
                 param.data = old_param_dict[name].clone().detach() - self.meta_optimizer_lr * average_grad
 
-    def meta_update(self, loss):
+    def meta_update(self, loss=None):
         """
         Applies an outer loop update on the meta-parameters of the model.
-        :param loss: The current crossentropy loss.
+        The meta-gradients have already been accumulated into .grad task by task in sample(),
+        so only the optimizer step is left here.
+        :param loss: The current meta loss returned by sample(); only kept for the callers.
         """
-        # optimizer.zero_grad() clears x.grad for every parameter x in the optimizer.
-        # It’s important to call this before loss.backward(),
-        # otherwise you’ll accumulate the gradients from multiple passes.
-        self.meta_optimizer.zero_grad()
-        # loss.backward() computes dloss/dx for every parameter x which has requires_grad=True.
-        # These are accumulated into x.grad for every parameter x. In pseudo-code:
-        # x.grad += dloss/dx
-        loss.backward()
+        # When no task had anything to train on there are no meta-gradients to apply.
+        if not self._meta_grads_ready:
+            return
         # To conduct a gradient ascent to minimize the loss (which is to maximize the reward).
         # optimizer.step updates the value of x using the gradient x.grad.
         # For example, the SGD optimizer performs:
         # x += -lr * x.grad
         self.meta_optimizer.step()
+        self._meta_grads_ready = False
 
     def reparam_meta_update(self, loss):
         """
@@ -199,6 +221,14 @@ class MetaLearner(object):
             param_dict[name] = param.to(device=self.device).clone().detach()
         return param_dict
 
+    def _action_tokens(self, actions):
+        """
+        Transform the IDs of an action sequence into uppercased output tokens, dropping '#END' and unknown IDs.
+        """
+        act_np = np.asarray(actions, dtype=np.int64)
+        act_np = act_np[act_np < len(self._rev_emb_arr)]
+        return self._rev_emb_arr[act_np[self._rev_emb_valid[act_np]]].tolist()
+
     def establish_support_set(self, task, N=5, weak=False, train_data_support_944K=None):
         # Find top-N in train_data_support;
         # get_top_N(train_data, train_data_support, N)
@@ -374,8 +404,8 @@ class MetaLearner(object):
         # nn.Module.zero_grad() Sets gradients of all model parameters to zero.
         # It’s important to call this before loss.backward(),
         # otherwise you’ll accumulate the gradients from multiple passes.
-        # self.net.zero_grad(names_weights_copy)
-        self.net.zero_grad()
+        # torch.autograd.grad returns the gradients instead of accumulating them into .grad,
+        # so there is nothing to zero here (and meta-gradients already accumulated in .grad are kept).
 
         # create_graph (bool, optional) – If True, graph of the derivative will be constructed,
         # allowing to compute higher order derivative products. Defaults to False.
@@ -385,51 +415,50 @@ class MetaLearner(object):
         # torch.autograd.grad(outputs, inputs, grad_outputs=None, retain_graph=None, create_graph=False, only_inputs=True, allow_unused=False):
         # outputs (sequence of Tensor) – outputs of the differentiated function.
         # inputs (sequence of Tensor) – Inputs w.r.t. which the gradient will be returned (and not accumulated into .grad).
-        # In this case, the gradient of self.parameters() is inputs.
+        # In this case, the gradient of names_weights_copy.values() is inputs.
         # The autograd.grad function returns an object that match the inputs argument,
-        # so we could get the the gradient of self.parameters() as returned value.
+        # so we could get the the gradient of names_weights_copy.values() as returned value.
         # Here if we do not use the first_order configuration, we set it as true.
-        # grads = torch.autograd.grad(inner_loss, names_weights_copy.values(),
-        #     create_graph=not first_order)
-        grads = torch.autograd.grad(inner_loss, self.net.parameters(),
+        # The gradients are taken w.r.t. the weights the inner loss was computed with (see _net_call),
+        # so the adapted weights stay connected to the meta-parameters.
+        grads = torch.autograd.grad(inner_loss, names_weights_copy.values(),
                                     create_graph=not first_order)
-        # self.named_parameters() is consisted of an iterator over module parameters,
-        # yielding both the name of the parameter as well as the parameter itself.
-        # grads is the gradient of self.parameters().
-        # Each module parameter is computed as parameter = parameter - step_size * grad.
-        # When being saved in the OrderedDict of self.named_parameters(), it likes:
-        # OrderedDict([('sigma', Parameter containing:
-        # tensor([0.6931, 0.6931], requires_grad=True)), ('0.weight', Parameter containing:
-        # tensor([[1., 1.],
-        #         [1., 1.]], requires_grad=True)), ('0.bias', Parameter containing:
-        # tensor([0., 0.], requires_grad=True)), ('1.weight', Parameter containing:
-        # tensor([[1., 1.],
-        #         [1., 1.]], requires_grad=True)), ('1.bias', Parameter containing:
-        # tensor([0., 0.], requires_grad=True))])
-        updated_names_weights_dict = dict()
-        # names_grads_wrt_params = dict(zip(names_weights_copy.keys(), grads))
-        # for key in names_grads_wrt_params.keys():
-        #     print(str(key)+': ')
-        #     print('names_weights_copy:')
-        #     print(names_weights_copy[key])
-        #     print('names_grads_wrt_params:')
-        #     print(names_grads_wrt_params[key])
-        #     updated_names_weights_dict[key] = names_weights_copy[key] - step_size * names_grads_wrt_params[key]
-        #     print('updated_names_weights_dict:')
-        #     print(updated_names_weights_dict[key])
-
-        for (name, param), grad in zip(self.net.named_parameters(), grads):
-            updated_names_weights_dict[name] = param - step_size * grad
-            # print(str(name) + ': ')
-            # print('self.net.named_parameters:')
-            # print(param)
-            # print('grad:')
-            # print(grad)
-            # print('updated_names_weights_dict:')
-            # print(updated_names_weights_dict[name])
+        # names_weights_copy maps each parameter name to the weight used in the inner loss,
+        # and grads is the gradient of names_weights_copy.values().
+        # Each weight is computed as weight = weight - step_size * grad.
+        # With first_order the grads carry no graph, so the update is FOMAML: the meta-gradient reaches
+        # the meta-parameters through the identity path of `weight` only.
+        updated_names_weights_dict = {name: weight - step_size * grad
+                                      for (name, weight), grad in zip(names_weights_copy.items(), grads)}
+        # Formatting a tensor copies it to the host, so only do it when debug output is wanted.
+        if log.isEnabledFor(logging.DEBUG):
+            for name, grad in zip(updated_names_weights_dict, grads):
+                log.debug("%s: grad=%s, updated=%s", name, grad, updated_names_weights_dict[name])
 
         return updated_names_weights_dict
 
+    def _calc_rewards(self, pending):
+        """
+        Score a list of (action_tokens, qa_info) pairs with utils.calc_True_Reward.
+        The symbolic execution of each sequence is independent, so they are spread over a pool of
+        worker processes, which is created on first use.
+        """
+        if not pending:
+            return []
+        if self._reward_pool is None:
+            self._reward_pool = multiprocessing.Pool(max(1, (os.cpu_count() or 2) // 2))
+        return self._reward_pool.starmap(utils.calc_True_Reward,
+                                         [(action_tokens, qa_info, self.adaptive) for action_tokens, qa_info in pending])
+
+    def _net_call(self, weights, method, *args, **kwargs):
+        """
+        Run the net's method with the parameters in `weights` in place of its own, without modifying the net.
+        Parameters missing from `weights` are taken from the net; with no weights the net is called directly.
+        """
+        if weights is None:
+            return getattr(self.net, method)(*args, **kwargs)
+        return functional_call(self.net, weights, (method,) + args, kwargs)
+
     # The loss used to calculate theta' for each pseudo-task.
     # Compute the inner loss for the one-step gradient update.
     # The inner loss is REINFORCE with baseline [2].
@@ -442,147 +471,150 @@ class MetaLearner(object):
         true_reward_argmax_step = []
         true_reward_sample_step = []
 
-        # TODO
-        if weights is not None:
-            self.net.insert_new_parameter(weights, True)
         # input_seq: the padded and embedded batch-sized input sequence.
         # input_batch: the token ID matrix of batch-sized input sequence. Each row is corresponding to one input sentence.
         # output_batch: the token ID matrix of batch-sized output sequences. Each row is corresponding to a list of several output sentences.
-        input_seq, input_batch, output_batch = self.net.pack_batch_no_out(batch, self.net.emb, self.device)
-        input_seq = input_seq.cuda()
+        input_seq, input_batch, output_batch = self._net_call(weights, 'pack_batch_no_out', batch, self.net.emb, self.device)
         # Get (two-layer) hidden state of encoder of samples in batch.
         # enc = net.encode(input_seq)
-        context, enc = self.net.encode_context(input_seq)
+        context, enc = self._net_call(weights, 'encode_context', input_seq)
 
         net_policies = []
         net_actions = []
-        net_advantages = []
+        # Every token of a trajectory shares the trajectory's advantage,
+        # so only the length and the advantage of each trajectory are kept here.
+        traj_lens = []
+        traj_advs = []
         # Transform ID to embedding.
-        beg_embedding = self.net.emb(self.beg_token)
-        beg_embedding = beg_embedding.cuda()
-
+        # Not cached across calls: every call runs with different (adapted) weights,
+        # and the lookup has to be part of this call's graph for the embedding to get its gradient.
+        beg_embedding = self._net_call(weights, 'emb', self.beg_token)
+
+        # Greedy decodes of all inputs and self.samples sampled decodes of every input are each run
+        # as one batched decode, and the rewards of each kind are scored in one batch.
+        # 'argmax_actions' is the list of output tokens generated greedily by using chain_argmax.
+        # The greedy decode only provides the self-critic baseline, so no graph is recorded for it.
+        with torch.no_grad():
+            _, argmax_actions = self._net_call(weights, 'decode_chain_argmax_batched', enc, beg_embedding,
+                                               data.MAX_TOKENS, context, stop_at_token=self.end_token)
+
+        # Get the highest BLEU score as baseline used in self-critic.
+        # If the last parameter is false, it means that the 0-1 reward is used to calculate the accuracy.
+        # Otherwise the adaptive reward is used.
+        # Show what the output action sequence is and score all of them at once.
+        argmax_rewards = self._calc_rewards([(self._action_tokens(argmax_actions[idx]), output_batch[idx])
+                                             for idx in range(len(input_batch))])
+        true_reward_argmax_step.extend(argmax_rewards)
+
+        # The indices of the inputs that are trained with sampled decodes.
+        train_idx = []
         for idx, inp_idx in enumerate(input_batch):
             # # Test whether the input sequence is correctly transformed into indices.
             # input_tokens = [rev_emb_dict[temp_idx] for temp_idx in inp_idx]
             # print (input_tokens)
-            # Get IDs of reference sequences' tokens corresponding to idx-th input sequence in batch.
-            qa_info = output_batch[idx]
-            # print("            Support sample %s is training..." % (qa_info['qid']))
-            # print (qa_info['qid'])
-            # # Get the (two-layer) hidden state of encoder of idx-th input sequence in batch.
-            item_enc = self.net.get_encoded_item(enc, idx)
-            # # 'r_argmax' is the list of out_logits list and 'actions' is the list of output tokens.
-            # # The output tokens are generated greedily by using chain_argmax (using last setp's output token as current input token).
-            r_argmax, actions = self.net.decode_chain_argmax(item_enc, beg_embedding, data.MAX_TOKENS, context[idx],
-                                                             stop_at_token=self.end_token)
-            # Show what the output action sequence is.
-            action_tokens = []
-            for temp_idx in actions:
-                if temp_idx in self.rev_emb_dict and self.rev_emb_dict.get(temp_idx) != '#END':
-                    action_tokens.append(str(self.rev_emb_dict.get(temp_idx)).upper())
-            # Get the highest BLEU score as baseline used in self-critic.
-            # If the last parameter is false, it means that the 0-1 reward is used to calculate the accuracy.
-            # Otherwise the adaptive reward is used.
-            # argmax_reward = utils.calc_True_Reward(action_tokens, qa_info, self.adaptive)
-            argmax_reward = random.random()
-            true_reward_argmax_step.append(argmax_reward)
-
-            # # In this case, the BLEU score is so high that it is not needed to train such case with RL.
-            # if not args.disable_skip and argmax_reward > 0.99:
-            #     skipped_samples += 1
-            #     continue
+            argmax_reward = argmax_rewards[idx]
 
             # In one epoch, when model is optimized for the first time, the optimized result is displayed here.
             # After that, all samples in this epoch don't display anymore.
             if not dial_shown:
                 # data.decode_words transform IDs to tokens.
                 log.info("Input: %s", utils.untokenize(data.decode_words(inp_idx, self.rev_emb_dict)))
-                log.info("Argmax: %s, reward=%.4f", utils.untokenize(data.decode_words(actions, self.rev_emb_dict)),
+                log.info("Argmax: %s, reward=%.4f", utils.untokenize(data.decode_words(argmax_actions[idx], self.rev_emb_dict)),
                          argmax_reward)
 
-            action_memory = list()
-            for _ in range(self.samples):
-                # 'r_sample' is the list of out_logits list and 'actions' is the list of output tokens.
-                # The output tokens are sampled following probabilitis by using chain_sampling.
-                r_sample, actions = self.net.decode_chain_sampling(item_enc, beg_embedding, data.MAX_TOKENS,
-                                                                   context[idx], stop_at_token=self.end_token)
-                total_samples += 1
-
-                # Omit duplicate action sequence to decrease the computing time and to avoid the case that
-                # the probability of such kind of duplicate action sequences would be increased redundantly and abnormally.
-                duplicate_flag = False
-                if len(action_memory) > 0:
-                    for temp_list in action_memory:
-                        if utils.duplicate(temp_list, actions):
-                            duplicate_flag = True
-                            break
-                if not duplicate_flag:
-                    action_memory.append(actions)
+            # In this case, the BLEU score is so high that it is not needed to train such case with RL,
+            # and its sampled decodes are not run at all.
+            if not self.disable_skip and argmax_reward > 0.99:
+                skipped_samples += 1
+                continue
+            train_idx.append(idx)
+
+        # The (input index, logits, actions) of every distinct sampled trajectory.
+        trajectories = []
+        if train_idx:
+            # Only the encoded inputs that are still trained are decoded with sampling.
+            if len(train_idx) < len(input_batch):
+                index_v = torch.as_tensor(train_idx, device=context.device)
+                if isinstance(enc, tuple):
+                    enc = tuple(e.index_select(1, index_v) for e in enc)
                 else:
-                    skipped_samples += 1
-                    continue
-                # Show what the output action sequence is.
-                action_tokens = []
-                for temp_idx in actions:
-                    if temp_idx in self.rev_emb_dict and self.rev_emb_dict.get(temp_idx) != '#END':
-                        action_tokens.append(str(self.rev_emb_dict.get(temp_idx)).upper())
-
-                # If the last parameter is false, it means that the 0-1 reward is used to calculate the accuracy.
-                # Otherwise the adaptive reward is used.
-                # sample_reward = utils.calc_True_Reward(action_tokens, qa_info, self.adaptive)
-                sample_reward = random.random()
-                true_reward_sample_step.append(sample_reward)
-
-                if not dial_shown:
-                    log.info("Sample: %s, reward=%.4f", utils.untokenize(data.decode_words(actions, self.rev_emb_dict)),
-                             sample_reward)
-
-                net_policies.append(r_sample)
-                net_actions.extend(actions)
-                # Regard argmax_bleu calculated from decode_chain_argmax as baseline used in self-critic.
-                # Each token has same reward as 'sample_bleu - argmax_bleu'.
-                # [x] * y: stretch 'x' to [1*y] list in which each element is 'x'.
-
-                # # If the argmax_reward is 1.0, then whatever the sample_reward is,
-                # # the probability of actions that get reward = 1.0 could not be further updated.
-                # # The GAMMA is used to adjust this scenario.
-                # if argmax_reward == 1.0:
-                #     net_advantages.extend([sample_reward - argmax_reward + GAMMA] * len(actions))
-                # else:
-                #     net_advantages.extend([sample_reward - argmax_reward] * len(actions))
-
-                net_advantages.extend([sample_reward - argmax_reward] * len(actions))
+                    enc = enc.index_select(1, index_v)
+                context = context.index_select(0, index_v)
+            # 'r_samples' is the logits of each sample and 'sample_actions' is the list of output tokens of each sample.
+            # The output tokens are sampled following probabilitis by using chain_sampling.
+            r_samples, sample_actions = self._net_call(weights, 'decode_chain_sampling_batched', enc, beg_embedding,
+                                                       data.MAX_TOKENS, context, self.samples,
+                                                       stop_at_token=self.end_token)
+
+            for pos, idx in enumerate(train_idx):
+                action_memory = set()
+                first, last = pos * self.samples, (pos + 1) * self.samples
+                for r_sample, actions in zip(r_samples[first:last], sample_actions[first:last]):
+                    total_samples += 1
+                    # Omit duplicate action sequence to decrease the computing time and to avoid the case that
+                    # the probability of such kind of duplicate action sequences would be increased redundantly and abnormally.
+                    action_key = tuple(actions)
+                    if action_key in action_memory:
+                        skipped_samples += 1
+                        continue
+                    action_memory.add(action_key)
+                    # Drop the steps decoded after this sample had already stopped.
+                    trajectories.append((idx, r_sample[:len(actions)], actions))
+
+        # If the last parameter is false, it means that the 0-1 reward is used to calculate the accuracy.
+        # Otherwise the adaptive reward is used.
+        sample_rewards = self._calc_rewards([(self._action_tokens(actions), output_batch[idx])
+                                             for idx, _, actions in trajectories])
+        true_reward_sample_step.extend(sample_rewards)
+
+        # When every sample of an input is rewarded exactly as its argmax baseline, all its advantages are zero
+        # and the input contributes no gradient.
+        informative_idx = {idx for (idx, _, _), sample_reward in zip(trajectories, sample_rewards)
+                           if sample_reward != argmax_rewards[idx]}
+        for (idx, r_sample, actions), sample_reward in zip(trajectories, sample_rewards):
+            if not dial_shown:
+                log.info("Sample: %s, reward=%.4f", utils.untokenize(data.decode_words(actions, self.rev_emb_dict)),
+                         sample_reward)
+            if idx not in informative_idx:
+                continue
+            net_policies.append(r_sample)
+            net_actions.extend(actions)
+            # Regard argmax_bleu calculated from decode_chain_argmax as baseline used in self-critic.
+            # Each token has same reward as 'sample_bleu - argmax_bleu'.
+
+            # # If the argmax_reward is 1.0, then whatever the sample_reward is,
+            # # the probability of actions that get reward = 1.0 could not be further updated.
+            # # The GAMMA is used to adjust this scenario.
+            # if argmax_reward == 1.0:
+            #     net_advantages.extend([sample_reward - argmax_reward + GAMMA] * len(actions))
+            # else:
+            #     net_advantages.extend([sample_reward - argmax_reward] * len(actions))
+
+            traj_lens.append(len(actions))
+            traj_advs.append(sample_reward - argmax_rewards[idx])
 
         if not net_policies:
             log.info("The net_policies is empty!")
-            # TODO the format of 0.0 should be the same as loss_v.
-            return 0.0, total_samples, skipped_samples
+            # There is nothing to train on, which callers detect by the loss being None.
+            return None, total_samples, skipped_samples, true_reward_argmax_step, true_reward_sample_step
 
         # Data for decode_chain_sampling samples and the number of such samples is the same as args.samples parameter.
         # Logits of all output tokens whose size is N * output vocab size; N is the number of output tokens of decode_chain_sampling samples.
         policies_v = torch.cat(net_policies)
-        policies_v = policies_v.cuda()
         # Indices of all output tokens whose size is 1 * N;
-        actions_t = torch.LongTensor(net_actions).to(self.device)
-        actions_t = actions_t.cuda()
+        actions_t = torch.as_tensor(net_actions, dtype=torch.long, device=self.device)
         # All output tokens reward whose size is 1 * N;
-        adv_v = torch.FloatTensor(net_advantages).to(self.device)
-        adv_v = adv_v.cuda()
-        # Compute log(softmax(logits)) of all output tokens in size of N * output vocab size;
-        log_prob_v = F.log_softmax(policies_v, dim=1)
-        log_prob_v = log_prob_v.cuda()
+        adv_v = torch.tensor(traj_advs, device=self.device).repeat_interleave(torch.tensor(traj_lens, device=self.device))
         # Q_1 = Q_2 =...= Q_n = BLEU(OUT,REF);
         # ▽J = Σ_n[Q▽logp(T)] = ▽Σ_n[Q*logp(T)] = ▽[Q_1*logp(T_1)+Q_2*logp(T_2)+...+Q_n*logp(T_n)];
-        # log_prob_v[range(len(net_actions)), actions_t]: for each output, get the output token's log(softmax(logits)).
-        # adv_v * log_prob_v[range(len(net_actions)), actions_t]:
-        # get Q * logp(T) for all tokens of all decode_chain_sampling samples in size of 1 * N;
-        log_prob_actions_v = adv_v * log_prob_v[range(len(net_actions)), actions_t]
-        log_prob_actions_v = log_prob_actions_v.cuda()
+        # cross_entropy fuses log(softmax(logits)) with picking each output token's entry,
+        # giving -logp(T) for all tokens of all decode_chain_sampling samples in size of 1 * N
+        # without materializing the N * output vocab size log-probabilities.
+        nll_v = F.cross_entropy(policies_v, actions_t, reduction='none')
         # For the optimizer is Adam (Adaptive Moment Estimation) which is a optimizer used for gradient descent.
-        # Therefore, to maximize ▽J (log_prob_actions_v) is to minimize -▽J.
+        # Therefore, to maximize ▽J is to minimize -▽J = mean(Q * -logp(T)).
         # .mean() is to calculate Monte Carlo sampling.
-        loss_policy_v = -log_prob_actions_v.mean()
-        loss_policy_v = loss_policy_v.cuda()
+        loss_policy_v = (adv_v * nll_v).mean()
 
         loss_v = loss_policy_v
         return loss_v, total_samples, skipped_samples, true_reward_argmax_step, true_reward_sample_step
@@ -627,10 +659,7 @@ class MetaLearner(object):
             r_argmax, actions = self.net.decode_chain_argmax(item_enc, beg_embedding, data.MAX_TOKENS, context[idx],
                                                              stop_at_token=self.end_token)
             # Show what the output action sequence is.
-            action_tokens = []
-            for temp_idx in actions:
-                if temp_idx in self.rev_emb_dict and self.rev_emb_dict.get(temp_idx) != '#END':
-                    action_tokens.append(str(self.rev_emb_dict.get(temp_idx)).upper())
+            action_tokens = self._action_tokens(actions)
             # Get the highest BLEU score as baseline used in self-critic.
             # If the last parameter is false, it means that the 0-1 reward is used to calculate the accuracy.
             # Otherwise the adaptive reward is used.
@@ -651,7 +680,7 @@ class MetaLearner(object):
                 log.info("Argmax: %s, reward=%.4f", utils.untokenize(data.decode_words(actions, self.rev_emb_dict)),
                          argmax_reward)
 
-            action_memory = list()
+            action_memory = set()
             for _ in range(self.samples):
                 # 'r_sample' is the list of out_logits list and 'actions' is the list of output tokens.
                 # The output tokens are sampled following probabilitis by using chain_sampling.
@@ -661,22 +690,13 @@ class MetaLearner(object):
 
                 # Omit duplicate action sequence to decrease the computing time and to avoid the case that
                 # the probability of such kind of duplicate action sequences would be increased redundantly and abnormally.
-                duplicate_flag = False
-                if len(action_memory) > 0:
-                    for temp_list in action_memory:
-                        if utils.duplicate(temp_list, actions):
-                            duplicate_flag = True
-                            break
-                if not duplicate_flag:
-                    action_memory.append(actions)
-                else:
+                action_key = tuple(actions)
+                if action_key in action_memory:
                     skipped_samples += 1
                     continue
+                action_memory.add(action_key)
                 # Show what the output action sequence is.
-                action_tokens = []
-                for temp_idx in actions:
-                    if temp_idx in self.rev_emb_dict and self.rev_emb_dict.get(temp_idx) != '#END':
-                        action_tokens.append(str(self.rev_emb_dict.get(temp_idx)).upper())
+                action_tokens = self._action_tokens(actions)
 
                 # If the last parameter is false, it means that the 0-1 reward is used to calculate the accuracy.
                 # Otherwise the adaptive reward is used.
@@ -724,13 +744,12 @@ class MetaLearner(object):
         log_prob_v = log_prob_v.cuda()
         # Q_1 = Q_2 =...= Q_n = BLEU(OUT,REF);
         # ▽J = Σ_n[Q▽logp(T)] = ▽Σ_n[Q*logp(T)] = ▽[Q_1*logp(T_1)+Q_2*logp(T_2)+...+Q_n*logp(T_n)];
-        # log_prob_v[range(len(net_actions)), actions_t]: for each output, get the output token's log(softmax(logits)).
-        # adv_v * log_prob_v[range(len(net_actions)), actions_t]:
+        # log_prob_v.gather(1, actions_t.unsqueeze(1)): for each output, get the output token's log(softmax(logits)).
+        # adv_v * log_prob_v.gather(1, actions_t.unsqueeze(1)).squeeze(1):
         # get Q * logp(T) for all tokens of all decode_chain_sampling samples in size of 1 * N;
-        # Suppose log_prob_v is a two-dimensional tensor, value of which is [[1,2,3],[4,5,6],[7,8,9]];
-        # log_prob_actions_v = log_prob_v[[0,1,2], [0,1,2]]
-        # log_prob_actions_v is: tensor([1, 5, 9], device='cuda:0').
-        log_prob_actions_v = adv_v * log_prob_v[range(len(net_actions)), actions_t]
+        # Suppose log_prob_v is a two-dimensional tensor, value of which is [[1,2,3],[4,5,6],[7,8,9]], and actions_t is [0,1,2];
+        # log_prob_v.gather(1, actions_t.unsqueeze(1)).squeeze(1) is: tensor([1, 5, 9], device='cuda:0').
+        log_prob_actions_v = adv_v * log_prob_v.gather(1, actions_t.unsqueeze(1)).squeeze(1)
         log_prob_actions_v = log_prob_actions_v.cuda()
         # For the optimizer is Adam (Adaptive Moment Estimation) which is a optimizer used for gradient descent.
         # Therefore, to maximize ▽J (log_prob_actions_v) is to minimize -▽J.
@@ -784,10 +803,7 @@ class MetaLearner(object):
             r_argmax, actions = self.reparam_net.module.decode_chain_argmax(item_enc, beg_embedding, data.MAX_TOKENS, context[idx],
                                                              stop_at_token=self.end_token)
             # Show what the output action sequence is.
-            action_tokens = []
-            for temp_idx in actions:
-                if temp_idx in self.rev_emb_dict and self.rev_emb_dict.get(temp_idx) != '#END':
-                    action_tokens.append(str(self.rev_emb_dict.get(temp_idx)).upper())
+            action_tokens = self._action_tokens(actions)
             # Get the highest BLEU score as baseline used in self-critic.
             # If the last parameter is false, it means that the 0-1 reward is used to calculate the accuracy.
             # Otherwise the adaptive reward is used.
@@ -808,7 +824,7 @@ class MetaLearner(object):
                 log.info("Argmax: %s, reward=%.4f", utils.untokenize(data.decode_words(actions, self.rev_emb_dict)),
                          argmax_reward)
 
-            action_memory = list()
+            action_memory = set()
             for _ in range(self.samples):
                 # 'r_sample' is the list of out_logits list and 'actions' is the list of output tokens.
                 # The output tokens are sampled following probabilitis by using chain_sampling.
@@ -818,22 +834,13 @@ class MetaLearner(object):
 
                 # Omit duplicate action sequence to decrease the computing time and to avoid the case that
                 # the probability of such kind of duplicate action sequences would be increased redundantly and abnormally.
-                duplicate_flag = False
-                if len(action_memory) > 0:
-                    for temp_list in action_memory:
-                        if utils.duplicate(temp_list, actions):
-                            duplicate_flag = True
-                            break
-                if not duplicate_flag:
-                    action_memory.append(actions)
-                else:
+                action_key = tuple(actions)
+                if action_key in action_memory:
                     skipped_samples += 1
                     continue
+                action_memory.add(action_key)
                 # Show what the output action sequence is.
-                action_tokens = []
-                for temp_idx in actions:
-                    if temp_idx in self.rev_emb_dict and self.rev_emb_dict.get(temp_idx) != '#END':
-                        action_tokens.append(str(self.rev_emb_dict.get(temp_idx)).upper())
+                action_tokens = self._action_tokens(actions)
 
                 # If the last parameter is false, it means that the 0-1 reward is used to calculate the accuracy.
                 # Otherwise the adaptive reward is used.
@@ -881,10 +888,10 @@ class MetaLearner(object):
         log_prob_v = log_prob_v.cuda()
         # Q_1 = Q_2 =...= Q_n = BLEU(OUT,REF);
         # ▽J = Σ_n[Q▽logp(T)] = ▽Σ_n[Q*logp(T)] = ▽[Q_1*logp(T_1)+Q_2*logp(T_2)+...+Q_n*logp(T_n)];
-        # log_prob_v[range(len(net_actions)), actions_t]: for each output, get the output token's log(softmax(logits)).
-        # adv_v * log_prob_v[range(len(net_actions)), actions_t]:
+        # log_prob_v.gather(1, actions_t.unsqueeze(1)): for each output, get the output token's log(softmax(logits)).
+        # adv_v * log_prob_v.gather(1, actions_t.unsqueeze(1)).squeeze(1):
         # get Q * logp(T) for all tokens of all decode_chain_sampling samples in size of 1 * N;
-        log_prob_actions_v = adv_v * log_prob_v[range(len(net_actions)), actions_t]
+        log_prob_actions_v = adv_v * log_prob_v.gather(1, actions_t.unsqueeze(1)).squeeze(1)
         log_prob_actions_v = log_prob_actions_v.cuda()
         # For the optimizer is Adam (Adaptive Moment Estimation) which is a optimizer used for gradient descent.
         # Therefore, to maximize ▽J (log_prob_actions_v) is to minimize -▽J.
@@ -898,21 +905,25 @@ class MetaLearner(object):
 
         return loss_v, total_samples, skipped_samples, true_reward_argmax_step, true_reward_sample_step
 
-    def sample(self, tasks, first_order=False, dial_shown=True, epoch_count=0, batch_count=0):
+    def sample(self, tasks, first_order=True, dial_shown=True, epoch_count=0, batch_count=0):
         """Sample trajectories (before and after the update of the parameters)
         for all the tasks `tasks`.
         Here number of tasks is 8.
         """
-        task_losses = []
+        task_loss_total = 0.0
+        trained_tasks = 0
         true_reward_argmax_batch = []
         true_reward_sample_batch = []
         total_samples = 0
         skipped_samples = 0
-        self.net.zero_grad()
+        # optimizer.zero_grad() clears x.grad for every parameter x in the optimizer.
+        # The meta-gradients of all tasks are accumulated into x.grad below and applied in meta_update.
+        self.meta_optimizer.zero_grad()
         # To get copied weights of the model for inner training.
+        # The meta-parameters do not change until meta_update, so the copy is built once and shared by all tasks;
+        # update_params always returns a new dict and never mutates it.
         initial_names_weights_copy = self.get_inner_loop_parameter_dict(self.net.named_parameters())
         for task in tasks:
-            # names_weights_copy = self.get_inner_loop_parameter_dict(self.net.named_parameters())
             names_weights_copy = initial_names_weights_copy
 
             log.info("Task %s is training..." % (str(task[1]['qid'])))
@@ -939,16 +950,28 @@ class MetaLearner(object):
                 # tensor([[1., 1.],
                 #         [1., 1.]], requires_grad=True)), ('1.bias', Parameter containing:
                 # tensor([0., 0.], requires_grad=True))])
-                names_weights_copy = self.update_params(inner_loss, names_weights_copy=names_weights_copy, step_size=self.fast_lr, first_order=first_order)
+                # A support sample that yields no trajectories to train on leaves the weights unchanged.
+                if inner_loss is not None:
+                    names_weights_copy = self.update_params(inner_loss, names_weights_copy=names_weights_copy, step_size=self.fast_lr, first_order=first_order)
+                # Drop the last reference to the inner loss so its graph can be freed before the next rollout;
+                # with first_order nothing downstream needs it.
+                inner_loss = None
 
             meta_loss, outer_total_samples, outer_skipped_samples, true_reward_argmax_step, true_reward_sample_step = self.inner_loss(task, weights=names_weights_copy, dial_shown=dial_shown)
-            task_losses.append(meta_loss)
+            if meta_loss is not None:
+                # Back-propagate each task's share of the mean meta loss right away,
+                # so that only one task's graph is alive at a time.
+                (meta_loss / len(tasks)).backward()
+                task_loss_total += meta_loss.item()
+                trained_tasks += 1
             total_samples += outer_total_samples
             skipped_samples += outer_skipped_samples
             true_reward_argmax_batch.extend(true_reward_argmax_step)
             true_reward_sample_batch.extend(true_reward_sample_step)
             log.info("Epoch %d, Batch %d, task %s is trained!" % (epoch_count, batch_count, str(task[1]['qid'])))
-        meta_losses = torch.mean(torch.stack(task_losses))
+        self._meta_grads_ready = trained_tasks > 0
+        # The mean meta loss is returned for reporting only; it carries no graph.
+        meta_losses = torch.tensor(task_loss_total / max(trained_tasks, 1), device=self.device)
         return meta_losses, total_samples, skipped_samples, true_reward_argmax_batch, true_reward_sample_batch
 
     # Using first-order to approximate the result of 2nd order MAML.
@@ -957,7 +980,8 @@ class MetaLearner(object):
         Sample trajectories (before and after the update of the parameters) for all the tasks `tasks`.
         Here number of tasks is 1.
         """
-        task_losses = []
+        # Running sum of the task meta losses.
+        meta_losses = 0.0
         grads_list = {}
         true_reward_argmax_batch = []
         true_reward_sample_batch = []
@@ -1000,7 +1024,8 @@ class MetaLearner(object):
             # otherwise you’ll accumulate the gradients from multiple passes.
             self.inner_optimizer.zero_grad()
             meta_loss, outer_total_samples, outer_skipped_samples, true_reward_argmax_step, true_reward_sample_step = self.first_order_inner_loss(task, dial_shown=dial_shown)
-            task_losses.append(meta_loss)
+            # The graph of meta_loss is consumed below, so only its value is summed.
+            meta_losses = meta_losses + meta_loss.detach()
             self.net.zero_grad()
             # Theta <- Theta - beta * (1/k) * ∑_(i=1:k)[grad(loss_theta_in/theta_in)]
             grads = torch.autograd.grad(meta_loss, self.net.grad_parameters())
@@ -1018,7 +1043,6 @@ class MetaLearner(object):
             true_reward_argmax_batch.extend(true_reward_argmax_step)
             true_reward_sample_batch.extend(true_reward_sample_step)
             log.info("Epoch %d, Batch %d, task %s is trained!" % (epoch_count, batch_count, str(task[1]['qid'])))
-        meta_losses = torch.sum(torch.stack(task_losses))
         return meta_losses, grads_list, total_samples, skipped_samples, true_reward_argmax_batch, true_reward_sample_batch
 
     # Using reptile to implement MAML.
@@ -1028,7 +1052,8 @@ class MetaLearner(object):
         for all the tasks `tasks`.
         Here number of tasks is 1.
         """
-        task_losses = []
+        # Running sum of the task meta losses.
+        meta_losses = 0.0
         true_reward_argmax_batch = []
         true_reward_sample_batch = []
         total_samples = 0
@@ -1079,7 +1104,8 @@ class MetaLearner(object):
             self.inner_optimizer.zero_grad()
             self.net.zero_grad()
             meta_loss, outer_total_samples, outer_skipped_samples, true_reward_argmax_step, true_reward_sample_step = self.first_order_inner_loss(task, dial_shown=dial_shown)
-            task_losses.append(meta_loss)
+            # The graph of meta_loss is consumed below, so only its value is summed.
+            meta_losses = meta_losses + meta_loss.detach()
 
             meta_loss.backward()
             # To conduct a gradient ascent to minimize the loss (which is to maximize the reward).
@@ -1103,7 +1129,6 @@ class MetaLearner(object):
             true_reward_argmax_batch.extend(true_reward_argmax_step)
             true_reward_sample_batch.extend(true_reward_sample_step)
             log.info("Epoch %d, Batch %d, task %s is trained!" % (epoch_count, batch_count, str(task[1]['qid'])))
-        meta_losses = torch.sum(torch.stack(task_losses))
         return meta_losses, running_vars, total_samples, skipped_samples, true_reward_argmax_batch, true_reward_sample_batch
 
     # Train the retriever.
@@ -1153,10 +1178,7 @@ class MetaLearner(object):
                                                      seq_len=data.MAX_TOKENS, context=context[0],
                                                      stop_at_token=self.end_token)
             # Show what the output action sequence is.
-            action_tokens = []
-            for temp_idx in actions:
-                if temp_idx in self.rev_emb_dict and self.rev_emb_dict.get(temp_idx) != '#END':
-                    action_tokens.append(str(self.rev_emb_dict.get(temp_idx)).upper())
+            action_tokens = self._action_tokens(actions)
             # Get the highest BLEU score as baseline used in self-critic.
             # If the last parameter is false, it means that the 0-1 reward is used to calculate the accuracy.
             # Otherwise the adaptive reward is used.
@@ -1210,10 +1232,7 @@ class MetaLearner(object):
                                                          seq_len=data.MAX_TOKENS, context=context[0],
                                                          stop_at_token=self.end_token)
                 # Show what the output action sequence is.
-                action_tokens = []
-                for temp_idx in actions:
-                    if temp_idx in self.rev_emb_dict and self.rev_emb_dict.get(temp_idx) != '#END':
-                        action_tokens.append(str(self.rev_emb_dict.get(temp_idx)).upper())
+                action_tokens = self._action_tokens(actions)
                 # Get the highest BLEU score as baseline used in self-critic.
                 # If the last parameter is false, it means that the 0-1 reward is used to calculate the accuracy.
                 # Otherwise the adaptive reward is used.
@@ -1246,7 +1265,8 @@ class MetaLearner(object):
         """Sample trajectories (before and after the update of the parameters)
         for all the tasks `tasks`.
         """
-        task_losses = []
+        # Running sum of the task meta losses.
+        meta_losses = 0.0
         true_reward_argmax_batch = []
         true_reward_sample_batch = []
         total_samples = 0
@@ -1286,13 +1306,12 @@ class MetaLearner(object):
                                                         lr=self.fast_lr, first_order=first_order)
 
             meta_loss, outer_total_samples, outer_skipped_samples, true_reward_argmax_step, true_reward_sample_step = self.reparam_inner_loss(task, weights=theta, dial_shown=dial_shown)
-            task_losses.append(meta_loss)
+            meta_losses = meta_losses + meta_loss
             total_samples += outer_total_samples
             skipped_samples += outer_skipped_samples
             true_reward_argmax_batch.extend(true_reward_argmax_step)
             true_reward_sample_batch.extend(true_reward_sample_step)
             log.info("Epoch %d, Batch %d, task %s is trained!" % (epoch_count, batch_count, str(task[1]['qid'])))
-        meta_losses = torch.sum(torch.stack(task_losses))
         return meta_losses, total_samples, skipped_samples, true_reward_argmax_batch, true_reward_sample_batch
 
     def sampleForTest(self, task, first_order=False, dial_shown=True, epoch_count=0, batch_count=0):
@@ -1335,7 +1354,9 @@ class MetaLearner(object):
             # tensor([[1., 1.],
             #         [1., 1.]], requires_grad=True)), ('1.bias', Parameter containing:
             # tensor([0., 0.], requires_grad=True))])
-            names_weights_copy = self.update_params(inner_loss, names_weights_copy=names_weights_copy, step_size=self.fast_lr, first_order=first_order)
+            if inner_loss is not None:
+                names_weights_copy = self.update_params(inner_loss, names_weights_copy=names_weights_copy, step_size=self.fast_lr, first_order=first_order)
+            inner_loss = None
 
         if names_weights_copy is not None:
             self.net.insert_new_parameter(names_weights_copy, True)
@@ -1458,9 +1479,6 @@ class MetaLearner(object):
         token_string = token_string.strip()
 
         # Show what the output action sequence is.
-        action_tokens = []
-        for temp_idx in tokens:
-            if temp_idx in self.rev_emb_dict and self.rev_emb_dict.get(temp_idx) != '#END':
-                action_tokens.append(str(self.rev_emb_dict.get(temp_idx)).upper())
+        action_tokens = self._action_tokens(tokens)
 
         return token_string, action_tokens
@@ -76,6 +76,11 @@ class PhraseModel(nn.Module):
                             params[name].grad = None
 
 
+    # PhraseModel has no single forward pass; forward dispatches to the named method so that
+    # any of them can be run through functional_call with a dict of substitute parameters (see MetaLearner).
+    def forward(self, method, *args, **kwargs):
+        return getattr(self, method)(*args, **kwargs)
+
     # Using the parameters to insert into network and compute output.
     def insert_new_parameter(self, state_dict, strict):
             self.load_state_dict(state_dict, strict)
@@ -171,6 +176,15 @@ class PhraseModel(nn.Module):
         # squeeze: Returns a tensor with all the dimensions of :attr:`input` of size `1` removed.
         return out.squeeze(dim=0), new_hid
 
+    def decode_one_batched(self, hid, input_x, context):
+        # Unlike decode_one, every row of input_x is the current token of a separate sequence:
+        # [B, emb] -> [B, 1, emb] with batch_first, and context is [B, input_len, hid].
+        out, new_hid = self.decoder(input_x.unsqueeze(1), hid)
+        if (self.attention_flag):
+            out, attn = self.attention(out, context)
+        out = self.output(out)
+        return out.squeeze(dim=1), new_hid
+
     def decode_chain_argmax(self, hid, begin_emb, seq_len, context, stop_at_token=None):
         """
         Decode sequence by feeding predicted token to the net again. Act greedily
@@ -260,6 +274,68 @@ class PhraseModel(nn.Module):
                 break
         return torch.cat(res_logits), res_actions
 
+    def _tile_for_decoding(self, hid, context, n_copies):
+        # Repeat every encoded input n_copies times along the batch dimension,
+        # so that rows [i * n_copies, (i + 1) * n_copies) all decode the i-th input.
+        if self.lstm_flag:
+            hid = tuple(h.repeat_interleave(n_copies, dim=1) for h in hid)
+        else:
+            hid = hid.repeat_interleave(n_copies, dim=1)
+        if context.dim() == 2:
+            context = context.unsqueeze(0)
+        if n_copies > 1:
+            context = context.repeat_interleave(n_copies, dim=0)
+        return hid, context
+
+    def _decode_chain_batched(self, hid, begin_emb, seq_len, context, stop_at_token, sample):
+        rows = context.size(0)
+        cur_emb = begin_emb.expand(rows, -1)
+        res_logits = []
+        res_actions = []
+        finished = torch.zeros(rows, dtype=torch.bool, device=begin_emb.device)
+
+        for _ in range(seq_len):
+            out_logits, hid = self.decode_one_batched(hid, cur_emb, context)
+            # The chosen index itself is not differentiated.
+            if sample:
+                action_v = torch.multinomial(F.softmax(out_logits.detach(), dim=1), 1).squeeze(1)
+            else:
+                action_v = torch.max(out_logits.detach(), dim=1)[1]
+            cur_emb = self.emb(action_v)
+
+            res_logits.append(out_logits)
+            res_actions.append(action_v)
+            if stop_at_token is not None:
+                finished |= action_v == stop_at_token
+                if bool(finished.all()):
+                    break
+
+        res_actions = torch.stack(res_actions, dim=1).tolist()
+        if stop_at_token is not None:
+            res_actions = [actions[:actions.index(stop_at_token) + 1] if stop_at_token in actions else actions
+                           for actions in res_actions]
+        return torch.stack(res_logits, dim=1), res_actions
+
+    def decode_chain_argmax_batched(self, hid, begin_emb, seq_len, context, stop_at_token=None):
+        """
+        Greedily decode every input of an encoded batch in a single batched decode.
+        hid is the encoder state of the whole batch and context is [B, input_len, hid] (or one 2-D context).
+        Return the logits in size of B * steps * output vocab size and the list of output token lists,
+        each of which is cut after its own stop token, so the first len(actions[i]) rows of logits[i] belong to it.
+        """
+        hid, context = self._tile_for_decoding(hid, context, 1)
+        return self._decode_chain_batched(hid, begin_emb, seq_len, context, stop_at_token, sample=False)
+
+    def decode_chain_sampling_batched(self, hid, begin_emb, seq_len, context, n_samples, stop_at_token=None):
+        """
+        Draw n_samples sequences for every input of an encoded batch in a single batched decode.
+        Act according to probabilities.
+        Rows [i * n_samples, (i + 1) * n_samples) of the result are the samples of the i-th input;
+        the logits and token lists are laid out as in decode_chain_argmax_batched.
+        """
+        hid, context = self._tile_for_decoding(hid, context, n_samples)
+        return self._decode_chain_batched(hid, begin_emb, seq_len, context, stop_at_token, sample=True)
+
     def beam_decode(self, hid, seq_len, context, start_token, stop_at_token = None, beam_width = 10, topk = 5):
         '''
         :param target_tensor: target indexes tensor of shape [B, T] where B is the batch size and T is the maximum length of the output sentence
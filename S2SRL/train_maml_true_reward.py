@@ -80,7 +80,8 @@ if __name__ == "__main__":
     # The action='store_true' means once the parameter is assigned a value, the action is to mark it as 'True';
     # If there is no value of the parameter, the value is assigned as 'False'.
     # Conversely, if action is 'store_false', if the parameter has a value, the parameter is viewed as 'False'.
-    parser.add_argument('--first-order', action='store_true', help='use the first-order approximation of MAML')
+    parser.add_argument('--first-order', action='store_true', default=True, help='use the first-order approximation of MAML (default)')
+    parser.add_argument('--second-order', dest='first_order', action='store_false', help='differentiate through the inner updates (full MAML)')
     parser.add_argument('--fast-lr', type=float, default=0.0001,
                         help='learning rate for the 1-step gradient update of MAML')
     parser.add_argument('--meta-lr', type=float, default=0.0001,
@@ -158,7 +159,7 @@ if __name__ == "__main__":
     beg_token = torch.LongTensor([emb_dict[data.BEGIN_TOKEN]]).to(device)
     beg_token = beg_token.cuda()
 
-    metaLearner = metalearner.MetaLearner(net, device=device, beg_token=beg_token, end_token=end_token, adaptive=args.adaptive, samples=args.samples, train_data_support_944K=train_data_944K, rev_emb_dict=rev_emb_dict, first_order=args.first_order, fast_lr=args.fast_lr, meta_optimizer_lr=args.meta_lr, dial_shown=False, dict=dict944k, dict_weak=dict944k_weak, steps=args.steps, weak_flag=args.weak)
+    metaLearner = metalearner.MetaLearner(net, device=device, beg_token=beg_token, end_token=end_token, adaptive=args.adaptive, samples=args.samples, train_data_support_944K=train_data_944K, rev_emb_dict=rev_emb_dict, first_order=args.first_order, fast_lr=args.fast_lr, meta_optimizer_lr=args.meta_lr, dial_shown=False, dict=dict944k, dict_weak=dict944k_weak, steps=args.steps, weak_flag=args.weak, disable_skip=args.disable_skip)
     log.info("Meta-learner: %d inner steps, %f inner learning rate, "
              "%d outer steps, %f outer learning rate, using weak mode:%s"
              %(args.steps, args.fast_lr, args.batches, args.meta_lr, str(args.weak)))